@@ -1,8 +1,15 @@
 import asyncio
+import hashlib
 import os
-from typing import Any, List
-from dataclasses import dataclass
-from openai import OpenAI
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from contextlib import ExitStack
+from typing import Any, List, NamedTuple
+from dataclasses import dataclass, field
+from datetime import datetime
+from openai import APIError, AsyncOpenAI
 from agents import Agent, Runner, RunContextWrapper, FileSearchTool, function_tool
 from agents.models import OpenAIResponsesModel
 
@@ -10,17 +17,18 @@ from agents.models import OpenAIResponsesModel
 # 1. ベクトルストアの設定とファイルアップロード
 # ========================================
 
-def setup_vector_store(api_key: str) -> str:
+async def setup_vector_store(client: AsyncOpenAI) -> str:
     """
     ベクトルストアを作成し、ドキュメントをアップロードする
     
+    Args:
+        client: 接続を確立済みの共有クライアント
+    
     Returns:
         str: 作成されたベクトルストアのID
     """
-    client = OpenAI(api_key=api_key)
-    
     # ベクトルストアの作成
-    vector_store = client.beta.vector_stores.create(
+    vector_store = await client.vector_stores.create(
         name="技術ドキュメントストア",
         description="技術文書やマニュアルを保存するベクトルストア"
     )
@@ -32,30 +40,18 @@ def setup_vector_store(api_key: str) -> str:
         "documents/user_guide.txt"
     ]
     
-    file_ids = []
-    for file_path in file_paths:
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as file:
-                uploaded_file = client.files.create(
-                    file=file,
-                    purpose="assistants"
-                )
-                file_ids.append(uploaded_file.id)
-    
-    # ファイルをベクトルストアに追加
-    if file_ids:
-        client.beta.vector_stores.files.create_batch(
-            vector_store_id=vector_store.id,
-            file_ids=file_ids
-        )
-    
-    # ベクトルストアの処理が完了するまで待機
-    import time
-    while True:
-        vector_store_status = client.beta.vector_stores.retrieve(vector_store.id)
-        if vector_store_status.status == "completed":
-            break
-        time.sleep(1)
+    # 並行アップロード・バッチ登録・処理完了の待機をSDKにまとめて任せる
+    # （途中のopenが失敗しても、開いたファイルはExitStackがすべて閉じる）
+    with ExitStack() as stack:
+        file_streams = [
+            stack.enter_context(open(path, "rb"))
+            for path in file_paths if os.path.exists(path)
+        ]
+        if file_streams:
+            await client.vector_stores.file_batches.upload_and_poll(
+                vector_store_id=vector_store.id,
+                files=file_streams
+            )
     
     return vector_store.id
 
@@ -64,17 +60,30 @@ def setup_vector_store(api_key: str) -> str:
 # 2. コンテキスト管理用のデータクラス
 # ========================================
 
-@dataclass
+# セッションごとに保持する検索履歴の最大件数
+MAX_SEARCH_HISTORY = 5
+
+
+@dataclass(slots=True)
 class RAGContext:
     """RAGシステムのコンテキスト情報を保持"""
     user_id: str
     session_id: str
     vector_store_ids: List[str]
-    search_history: List[dict] = None
-    
-    def __post_init__(self):
-        if self.search_history is None:
-            self.search_history = []
+    # ベクトルストアIDごとのメタデータ（例: {"tenant": "user_a"}）
+    store_metadata: dict[str, dict] = field(default_factory=dict)
+    # 古い検索履歴から捨て、セッションが長くなっても件数を一定に保つ
+    search_history: deque = field(
+        default_factory=lambda: deque(maxlen=MAX_SEARCH_HISTORY)
+    )
+    # (検索履歴数, 指示文) の組。履歴数が変わるまで指示文を再利用する
+    _cached_instructions: tuple[int, str] | None = field(default=None, init=False, repr=False)
+
+
+class ConversationTurn(NamedTuple):
+    """マルチターン会話の1ターン分の記録"""
+    query: str
+    response: str
 
 
 # ========================================
@@ -102,7 +111,7 @@ async def analyze_search_results(
     ctx.context.search_history.append({
         "query": query,
         "results": results,
-        "timestamp": __import__("datetime").datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat()
     })
     
     # 結果を分析（実際の実装では、より高度な分析を行う）
@@ -137,11 +146,15 @@ async def get_additional_context(
         str: 追加コンテキスト情報
     """
     # 実際の実装では外部APIや別のデータソースから情報を取得
+    # （参照数はFileSearchToolと同じく、このユーザーが検索できるストアに限る）
+    store_ids = select_vector_stores(
+        ctx.context.vector_store_ids, ctx.context.store_metadata, ctx.context.user_id
+    )
     additional_info = f"""
     トピック「{topic}」に関する追加情報:
     - 最終更新: 2024年12月
     - 関連トピック: API設計、システムアーキテクチャ
-    - 参照ドキュメント数: {len(ctx.context.vector_store_ids)}
+    - 参照ドキュメント数: {len(store_ids)}
     """
     
     return additional_info
@@ -151,9 +164,41 @@ async def get_additional_context(
 # 4. RAG Agentの実装
 # ========================================
 
+# FileSearchToolの取得件数の上限とスコアしきい値
+# （しきい値未満の関連度の低いチャンクはプロンプトに含めない）
+FILE_SEARCH_MAX_RESULTS = 5
+FILE_SEARCH_SCORE_THRESHOLD = 0.6
+
+
+def select_vector_stores(
+    vector_store_ids: List[str],
+    store_metadata: dict[str, dict],
+    user_id: str
+) -> List[str]:
+    """
+    メタデータを使って検索対象のベクトルストアを事前に絞り込む
+    
+    tenantが設定されたストアはそのユーザーの場合だけ対象とし、
+    tenantのないストアは全ユーザー共通として扱う
+    
+    Args:
+        vector_store_ids: 候補となるベクトルストアID
+        store_metadata: ベクトルストアIDごとのメタデータ
+        user_id: ユーザーID
+    
+    Returns:
+        List[str]: 検索対象とするベクトルストアID
+    """
+    return [
+        store_id for store_id in vector_store_ids
+        if store_metadata.get(store_id, {}).get("tenant") in (None, user_id)
+    ]
+
+
 def create_rag_agent(
     vector_store_ids: List[str],
-    context: RAGContext
+    context: RAGContext,
+    openai_client: AsyncOpenAI
 ) -> Agent[RAGContext]:
     """
     FileSearchToolを使用したRAG Agentを作成
@@ -161,6 +206,7 @@ def create_rag_agent(
     Args:
         vector_store_ids: 検索対象のベクトルストアID
         context: RAGコンテキスト
+        openai_client: モデル呼び出しに使う共有クライアント
     
     Returns:
         Agent: 設定済みのRAG Agent
@@ -168,7 +214,13 @@ def create_rag_agent(
     
     # 動的な指示を生成する関数
     def dynamic_instructions(ctx: RunContextWrapper[RAGContext]) -> str:
-        return f"""
+        # 検索履歴数が前回と同じなら、組み立て済みの指示文を返す
+        history_count = len(ctx.context.search_history)
+        cached = ctx.context._cached_instructions
+        if cached is not None and cached[0] == history_count:
+            return cached[1]
+        
+        instructions = f"""
         あなたは高度なRAGシステムアシスタントです。
         
         ## あなたの役割:
@@ -179,22 +231,24 @@ def create_rag_agent(
         ## 現在のセッション情報:
         - ユーザーID: {ctx.context.user_id}
         - セッションID: {ctx.context.session_id}
-        - 検索履歴数: {len(ctx.context.search_history)}
+        - 検索履歴数: {history_count}
         
         ## 回答方針:
         - 検索結果に基づいて正確に回答する
         - 情報が不足している場合は、その旨を明確に伝える
         - 技術的な内容は分かりやすく説明する
         """
+        ctx.context._cached_instructions = (history_count, instructions)
+        return instructions
     
     # FileSearchToolの設定
     file_search_tool = FileSearchTool(
         vector_store_ids=vector_store_ids,
-        max_num_results=5,  # 最大5件の結果を取得
+        max_num_results=FILE_SEARCH_MAX_RESULTS,  # 取得する結果の上限
         include_search_results=True,  # LLMの出力に検索結果を含める
         ranking_options={
             "ranker": "default_2024_08_21",  # ランキングアルゴリズム
-            "score_threshold": 0.0  # スコアしきい値
+            "score_threshold": FILE_SEARCH_SCORE_THRESHOLD  # スコアしきい値
         }
     )
     
@@ -207,7 +261,10 @@ def create_rag_agent(
             analyze_search_results,
             get_additional_context
         ],
-        model=OpenAIResponsesModel(model="gpt-4o-mini")
+        model=OpenAIResponsesModel(
+            model="gpt-4o-mini",
+            openai_client=openai_client
+        )
     )
     
     return agent
@@ -220,22 +277,55 @@ def create_rag_agent(
 class AdvancedRAGPipeline:
     """高度なRAG処理パイプライン"""
     
+    # 応答キャッシュの最大件数と有効期間（秒）
+    ANSWER_CACHE_SIZE = 512
+    ANSWER_CACHE_TTL = 300.0
+    
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self.client = OpenAI(api_key=api_key)
+        self.client = AsyncOpenAI(api_key=api_key)
         self.vector_store_ids = []
+        self.store_metadata: dict[str, dict] = {}
+        self._answer_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._pending_answers: dict[str, asyncio.Task] = {}
+        self._agent_cache: dict[tuple[str, ...], Agent[RAGContext]] = {}
     
-    async def initialize(self, documents: List[str] = None):
+    def _get_agent(self, context: RAGContext) -> Agent[RAGContext]:
+        """
+        検索対象のベクトルストアの組ごとにAgentを1度だけ作成して再利用する
+        
+        指示文はdynamic_instructionsが実行時のコンテキストから生成するため、
+        Agent自体はクエリやセッションに依存しない
+        """
+        key = tuple(select_vector_stores(
+            context.vector_store_ids, context.store_metadata, context.user_id
+        ))
+        agent = self._agent_cache.get(key)
+        if agent is None:
+            agent = self._agent_cache[key] = create_rag_agent(list(key), context, self.client)
+        return agent
+    
+    async def initialize(self, documents: List[str] = None, metadata: dict = None):
         """
         パイプラインの初期化
         
         Args:
             documents: アップロードするドキュメントのリスト
+            metadata: 作成するベクトルストアのメタデータ（例: {"tenant": "user_a"}）
         """
+        # api.openai.com への接続を先に確立し、最初の質問でハンドシェイクを待たないようにする
+        try:
+            await self.client.with_options(timeout=5).models.list()
+        except APIError as e:
+            print(f"⚠️ 接続の事前確立に失敗しました: {e}")
+        
         if documents:
             # ドキュメントをベクトルストアにアップロード
-            vector_store_id = setup_vector_store(self.api_key)
-            self.vector_store_ids.append(vector_store_id)
+            vector_store_id = await setup_vector_store(self.client)
+            # 重複を除いて並べ替え、Agent・応答キャッシュのキーを安定させる
+            self.vector_store_ids = sorted(set(self.vector_store_ids) | {vector_store_id})
+            if metadata:
+                self.store_metadata[vector_store_id] = metadata
     
     async def search_and_respond(
         self,
@@ -254,19 +344,57 @@ class AdvancedRAGPipeline:
         Returns:
             str: 生成された応答
         """
+        # 指示文にユーザーID・セッションIDが含まれるため、応答はそれらごとにキャッシュする
+        store_ids = select_vector_stores(self.vector_store_ids, self.store_metadata, user_id)
+        key = hashlib.sha256(
+            "|".join([query, user_id, session_id or "", *store_ids]).encode()
+        ).hexdigest()
+        
+        # キャッシュ済みの応答があれば再利用
+        cached = self._answer_cache.get(key)
+        if cached is not None:
+            expires_at, answer = cached
+            if expires_at > time.monotonic():
+                self._answer_cache.move_to_end(key)
+                return answer
+            del self._answer_cache[key]
+        
+        # 同じクエリが実行中なら、その結果を待って共有する
+        task = self._pending_answers.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run_query(query, user_id, session_id))
+            self._pending_answers[key] = task
+            task.add_done_callback(lambda _: self._pending_answers.pop(key, None))
+        # 待機中の呼び出し元がキャンセルされても、共有タスクは止めない
+        answer = await asyncio.shield(task)
+        
+        self._answer_cache[key] = (time.monotonic() + self.ANSWER_CACHE_TTL, answer)
+        self._answer_cache.move_to_end(key)
+        if len(self._answer_cache) > self.ANSWER_CACHE_SIZE:
+            self._answer_cache.popitem(last=False)
+        
+        return answer
+    
+    async def _run_query(
+        self,
+        query: str,
+        user_id: str,
+        session_id: str = None
+    ) -> str:
+        """Agentを実行して応答を生成（キャッシュを介さない）"""
         if session_id is None:
-            import uuid
-            session_id = str(uuid.uuid4())
+            session_id = uuid.uuid4().hex
         
         # コンテキストの作成
         context = RAGContext(
             user_id=user_id,
             session_id=session_id,
-            vector_store_ids=self.vector_store_ids
+            vector_store_ids=self.vector_store_ids,
+            store_metadata=self.store_metadata
         )
         
-        # Agentの作成
-        agent = create_rag_agent(self.vector_store_ids, context)
+        # Agentの取得（キャッシュ済みなら再利用）
+        agent = self._get_agent(context)
         
         # クエリの実行
         result = await Runner.run(
@@ -280,34 +408,49 @@ class AdvancedRAGPipeline:
     async def multi_turn_conversation(
         self,
         queries: List[str],
-        user_id: str = "default_user"
+        user_id: str = "default_user",
+        dependencies: List[set[int]] = None,
+        verbose: bool = True
     ):
         """
         マルチターンの会話を処理
         
+        依存関係のないターンはまとめて並行実行し、依存先のターンが
+        すべて完了したターンから順に実行する
+        
         Args:
             queries: クエリのリスト
             user_id: ユーザーID
+            dependencies: 各ターンが依存するターンのインデックス集合のリスト
+                （省略時は各ターンが直前のターンに依存し、順番に実行される）
+            verbose: 各ターンの質問と回答を表示するかどうか
         """
-        import uuid
-        session_id = str(uuid.uuid4())
+        session_id = uuid.uuid4().hex
         
         context = RAGContext(
             user_id=user_id,
             session_id=session_id,
-            vector_store_ids=self.vector_store_ids
+            vector_store_ids=self.vector_store_ids,
+            store_metadata=self.store_metadata
         )
         
-        agent = create_rag_agent(self.vector_store_ids, context)
+        agent = self._get_agent(context)
         
-        conversation_history = []
+        if dependencies is None:
+            dependencies = [{i - 1} if i else set() for i in range(len(queries))]
+        elif len(dependencies) != len(queries):
+            raise ValueError("dependencies は queries と同じ長さで指定してください")
         
-        for query in queries:
-            print(f"\n👤 User: {query}")
+        async def run_turn(index: int) -> str:
+            query = queries[index]
             
-            # 前回の会話履歴を含めてクエリを構築
-            if conversation_history:
-                full_query = f"以前の会話を考慮して回答してください:\n{query}"
+            # 依存するターンがあれば、そのやり取りを添えて以前の会話を考慮するよう指示
+            if dependencies[index]:
+                previous = "\n\n".join(
+                    f"質問: {queries[j]}\n回答: {responses[j]}"
+                    for j in sorted(dependencies[index])
+                )
+                full_query = f"以前の会話を考慮して回答してください:\n{previous}\n\n質問: {query}"
             else:
                 full_query = query
             
@@ -317,13 +460,38 @@ class AdvancedRAGPipeline:
                 context=context
             )
             
-            response = result.final_output
-            print(f"🤖 Assistant: {response}")
+            return result.final_output
+        
+        responses = [None] * len(queries)
+        completed: set[int] = set()
+        
+        while len(completed) < len(queries):
+            # 依存先がすべて完了しているターンをまとめて並行実行
+            ready = [
+                i for i in range(len(queries))
+                if i not in completed and dependencies[i] <= completed
+            ]
+            if not ready:
+                raise ValueError("dependencies に循環または範囲外の依存があります")
+            
+            level_responses = await asyncio.gather(*(run_turn(i) for i in ready))
+            
+            lines = []
+            for i, response in zip(ready, level_responses):
+                lines.append(f"\n👤 User: {queries[i]}")
+                lines.append(f"🤖 Assistant: {response}")
+                responses[i] = response
             
-            conversation_history.append({
-                "query": query,
-                "response": response
-            })
+            # 同時に完了したターンの表示は1回の書き込みにまとめる
+            if verbose:
+                print("\n".join(lines))
+            
+            completed.update(ready)
+        
+        conversation_history = []
+        
+        for query, response in zip(queries, responses):
+            conversation_history.append(ConversationTurn(query, response))
         
         return conversation_history
 
@@ -344,8 +512,9 @@ async def main():
     # RAGパイプラインの初期化
     pipeline = AdvancedRAGPipeline(api_key)
     
-    # ベクトルストアの初期化（実際のファイルがある場合）
+    # パイプラインの初期化（実際のファイルがある場合は documents を指定）
     # await pipeline.initialize(documents=["path/to/doc1.pdf", "path/to/doc2.md"])
+    await pipeline.initialize()
     
     # 単一クエリの実行例
     print("=" * 50)
@@ -368,7 +537,11 @@ async def main():
         "パフォーマンスの最適化方法についても教えてください"
     ]
     
-    await pipeline.multi_turn_conversation(queries)
+    # 2問目だけが1問目の回答に依存し、3問目は独立して並行実行できる
+    await pipeline.multi_turn_conversation(
+        queries,
+        dependencies=[set(), {0}, set()]
+    )
     
     print("\n✅ デモ完了")
 
@@ -383,7 +556,6 @@ async def run_with_error_handling():
         await main()
     except Exception as e:
         print(f"❌ エラーが発生しました: {e}")
-        import traceback
         traceback.print_exc()
 
 
@@ -1,127 +1,94 @@
 import asyncio
 import os
-from openai import OpenAI
+from typing import Callable
+from rag_common import close_client, get_client, upload_files_and_create_assistant
 
 # ========================================
-# 1. ファイルアップロードとAssistant作成
+# 1. シンプルなRAGクエリ実行
 # ========================================
 
-def upload_files_and_create_assistant(file_paths: list[str]) -> tuple[str, list[str]]:
-    """ファイルをアップロードしてAssistantを作成（シンプル版）"""
-    
-    client = OpenAI()
-    
-    # ファイルをアップロード
-    file_ids = []
-    for path in file_paths:
-        if os.path.exists(path):
-            with open(path, "rb") as file:
-                uploaded = client.files.create(
-                    file=file,
-                    purpose="assistants"
-                )
-                file_ids.append(uploaded.id)
-                print(f"✅ ファイルアップロード完了: {path} (ID: {uploaded.id})")
-        else:
-            print(f"⚠️ ファイルが見つかりません: {path}")
-    
-    # Assistantを作成（ファイル検索機能付き）
-    assistant = client.beta.assistants.create(
-        name="RAG Assistant",
-        instructions="""
-        あなたはドキュメント検索アシスタントです。
-        ユーザーの質問に対して、アップロードされたファイルから関連情報を検索し、
-        正確で役立つ回答を提供してください。
-        
-        回答時は以下の点に注意してください：
-        - ファイルの内容に基づいた正確な情報を提供する
-        - 不明な点は「ファイルに記載されていない」と明記する
-        - 情報の出典となるファイル名も併せて示す
-        """,
-        model="gpt-4o",
-        tools=[{"type": "file_search"}]
-    )
-    
-    print(f"✅ Assistant作成完了: {assistant.id}")
-    return assistant.id, file_ids
-
-
-# ========================================
-# 2. シンプルなRAGクエリ実行
-# ========================================
-
-def simple_rag_query(assistant_id: str, query: str) -> str:
-    """最もシンプルなRAGクエリの実行"""
-    
-    client = OpenAI()
-    
-    # 新しいスレッドを作成
-    thread = client.beta.threads.create()
-    
-    # メッセージを追加
-    message = client.beta.threads.messages.create(
-        thread_id=thread.id,
-        role="user",
-        content=query
-    )
-    
-    # Assistantを実行
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant_id
-    )
-    
-    # 実行完了を待つ
-    while run.status in ['queued', 'in_progress', 'cancelling']:
-        run = client.beta.threads.runs.retrieve(
-            thread_id=thread.id,
-            run_id=run.id
-        )
-        if run.status == 'completed':
-            break
-    
-    # 結果を取得
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
-    
-    # 最新のアシスタントメッセージを取得
-    for message in messages.data:
-        if message.role == "assistant":
-            return message.content[0].text.value
+async def simple_rag_query(
+    assistant_id: str,
+    query: str,
+    on_delta: Callable[[str], None] | None = None
+) -> str:
+    """最もシンプルなRAGクエリの実行（on_deltaを渡すと回答の断片を受信順に通知）"""
+    
+    client = get_client()
+    
+    # スレッド作成・メッセージ追加・Assistant実行を1回のリクエストで行い、
+    # 回答をストリーミングで受け取る（完了はストリームの終了で即座に分かる）
+    chunks = []
+    async with client.beta.threads.create_and_run_stream(
+        assistant_id=assistant_id,
+        thread={"messages": [{"role": "user", "content": query}]}
+    ) as stream:
+        async for text in stream.text_deltas:
+            chunks.append(text)
+            if on_delta is not None:
+                on_delta(text)
+    
+    if chunks:
+        return "".join(chunks)
     
     return "回答を取得できませんでした。"
 
 
 # ========================================
-# 3. メイン実行
+# 2. メイン実行
 # ========================================
 
-def main():
+async def main():
     """RAGシステムの実行例"""
     
-    # 1. ファイルアップロードとAssistant作成
-    print("🚀 RAGシステムを初期化中...")
-    assistant_id, file_ids = upload_files_and_create_assistant([
-        "documents/VectorembeddingsOpenAI.pdf",
-        "documents/VectorembeddingsOpenAI.txt"
-    ])
-    
-    print(f"✅ アップロードされたファイル数: {len(file_ids)}")
-    
-    # 2. 質問応答の実行
-    questions = [
-        "APIの認証方法について教えてください",
-        "エラーハンドリングのベストプラクティスは？",
-        "パフォーマンス最適化の方法を教えてください"
-    ]
-    
-    for question in questions:
-        print(f"\n📝 質問: {question}")
+    try:
+        # 1. ファイルアップロードとAssistant作成
+        print("🚀 RAGシステムを初期化中...")
+        assistant_id, file_ids = await upload_files_and_create_assistant([
+            "documents/VectorembeddingsOpenAI.pdf",
+            "documents/VectorembeddingsOpenAI.txt"
+        ])
         
-        # RAGクエリを実行
-        answer = simple_rag_query(assistant_id, question)
+        print(f"✅ アップロードされたファイル数: {len(file_ids)}")
+        
+        # 2. 質問応答の実行
+        questions = [
+            "APIの認証方法について教えてください",
+            "エラーハンドリングのベストプラクティスは？",
+            "パフォーマンス最適化の方法を教えてください"
+        ]
+        
+        async def ask(question: str) -> tuple[str, str]:
+            return question, await simple_rag_query(assistant_id, question)
+        
+        # 残りの質問は裏で並行して実行しておく
+        pending = [asyncio.create_task(ask(question)) for question in questions[1:]]
+        
+        # 最初の質問は回答の断片を受信した順に表示する（表示が混ざらないよう1問だけ）
+        print(f"\n📝 質問: {questions[0]}")
+        print("🤖 回答: ", end="", flush=True)
+        streamed = []
+        
+        def show_delta(text: str) -> None:
+            streamed.append(text)
+            print(text, end="", flush=True)
+        
+        answer = await simple_rag_query(assistant_id, questions[0], show_delta)
+        # 断片が1つも届かなかった場合は代替メッセージを表示
+        if streamed:
+            print()
+        else:
+            print(answer)
         
-        print(f"🤖 回答: {answer}")
+        # 残りは回答が揃ったものから表示
+        for finished in asyncio.as_completed(pending):
+            question, answer = await finished
+            print(f"\n📝 質問: {question}")
+            print(f"🤖 回答: {answer}")
 
+    finally:
+        # コネクションプールはイベントループが終わる前に閉じる
+        await close_client()
 
 # ========================================
 # 実行
@@ -136,4 +103,4 @@ if __name__ == "__main__":
         exit(1)
     
     # 実行
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, NotFoundError
+
+# ========================================
+# 共有クライアント
+# ========================================
+
+_client: AsyncOpenAI | None = None
+
+
+def get_client() -> AsyncOpenAI:
+    """全リクエストで共有するAsyncOpenAIクライアントを取得（初回呼び出し時に作成）"""
+    global _client
+    if _client is None:
+        # コネクションプールを共有し、keep-aliveでTCP/TLS接続を再利用する
+        # （SDK既定のトランスポート設定を保つため DefaultAsyncHttpxClient を使う）
+        _client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                timeout=120.0
+            )
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """共有クライアントのコネクションプールを閉じる（イベントループ終了前に呼ぶ）"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+# ========================================
+# 1. ファイルアップロードとAssistant作成
+# ========================================
+
+# アップロード済みファイルのキャッシュ（内容のSHA-256 → file_id）
+FILE_ID_CACHE_PATH = Path("~/.cache/rag_file_ids.json").expanduser()
+
+
+def load_file_id_cache() -> dict[str, str]:
+    """アップロード済みファイルのキャッシュを読み込む"""
+    if FILE_ID_CACHE_PATH.exists():
+        return json.loads(FILE_ID_CACHE_PATH.read_text(encoding="utf-8"))
+    return {}
+
+
+def save_file_id_cache(cache: dict[str, str]) -> None:
+    """アップロード済みファイルのキャッシュを保存する"""
+    FILE_ID_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    FILE_ID_CACHE_PATH.write_text(json.dumps(cache, indent=2), encoding="utf-8")
+
+
+async def upload_files_and_create_assistant(file_paths: list[str]) -> tuple[str, list[str]]:
+    """ファイルをアップロードしてAssistantを作成（02・03のサンプルで共通）"""
+    
+    client = get_client()
+    
+    file_id_cache = load_file_id_cache()
+    
+    async def upload(path: str) -> str:
+        with open(path, "rb") as file:
+            digest = hashlib.file_digest(file, "sha256").hexdigest()
+        
+        # 同じ内容のファイルがアップロード済みで、まだ存在していれば再利用
+        cached_id = file_id_cache.get(digest)
+        if cached_id is not None:
+            try:
+                await client.files.retrieve(cached_id)
+            except NotFoundError:
+                pass
+            else:
+                print(f"♻️ アップロード済みのファイルを再利用: {path} (ID: {cached_id})")
+                return cached_id
+        
+        with open(path, "rb") as file:
+            uploaded = await client.files.create(
+                file=file,
+                purpose="assistants"
+            )
+        file_id_cache[digest] = uploaded.id
+        print(f"✅ ファイルアップロード完了: {path} (ID: {uploaded.id})")
+        return uploaded.id
+    
+    existing_paths = []
+    for path in file_paths:
+        if os.path.exists(path):
+            existing_paths.append(path)
+        else:
+            print(f"⚠️ ファイルが見つかりません: {path}")
+    
+    # ファイルを並行してアップロード（結果はfile_pathsの順序を保つ）
+    file_ids = list(await asyncio.gather(*(upload(path) for path in existing_paths)))
+    save_file_id_cache(file_id_cache)
+    
+    # Assistantを作成（ファイル検索機能付き）
+    assistant = await client.beta.assistants.create(
+        name="RAG Assistant",
+        instructions="""
+        あなたはドキュメント検索アシスタントです。
+        ユーザーの質問に対して、アップロードされたファイルから関連情報を検索し、
+        正確で役立つ回答を提供してください。
+        
+        回答時は以下の点に注意してください：
+        - ファイルの内容に基づいた正確な情報を提供する
+        - 不明な点は「ファイルに記載されていない」と明記する
+        - 情報の出典となるファイル名も併せて示す
+        """,
+        model="gpt-4o",
+        tools=[{"type": "file_search"}]
+    )
+    
+    print(f"✅ Assistant作成完了: {assistant.id}")
+    return assistant.id, file_ids